@@ -2,6 +2,7 @@ import asyncio
 import logging
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from automation_server_client import AutomationServer, Workqueue, WorkItemError, Credential, WorkItemStatus
 from momentum_client.manager import MomentumClientManager
@@ -11,93 +12,153 @@ from process.momentum_service import MomentumService
 momentum: MomentumClientManager
 momentum_service: MomentumService
 
+maks_samtidige_opslag = 8
+maks_samtidige_borgere = 8
+
+borger_filtre = [
+    {
+        "customFilter": "",
+        "fieldName": "targetGroupCode",
+        "values": [
+            "INT-KP",
+            "6.2"
+        ]
+    },
+    {
+        "customFilter": "",
+        "fieldName": "primaryCaseworkerTeamId",
+        "values": [
+            "",
+            "b345ab13-e8b8-409f-b87b-6925268472de",
+            "80180c8c-5863-40ae-a85b-e14d33597e6a",
+            "c58e4d9f-af8e-4553-a3d0-c2b102cc33c2"
+        ]
+    },
+    {
+        "customFilter": "exclude",
+        "fieldName": "absences",
+        "values": [
+            "ABSENCE_BARSEL",
+            "ABSENCE_FRITAGELSE_FOR_JOBLOG"
+        ]
+    }
+]
+
 async def populate_queue(workqueue: Workqueue):
-    filters = [
-        {
-            "customFilter": "",
-            "fieldName": "targetGroupCode",
-            "values": [
-                "INT-KP",
-                "6.2"
-            ]
-        },
-        {
-            "customFilter": "",
-            "fieldName": "primaryCaseworkerTeamId",
-            "values": [
-                "",
-                "b345ab13-e8b8-409f-b87b-6925268472de",
-                "80180c8c-5863-40ae-a85b-e14d33597e6a",
-                "c58e4d9f-af8e-4553-a3d0-c2b102cc33c2"
-            ]
-        },
-        {
-            "customFilter": "exclude",
-            "fieldName": "absences",
-            "values": [                
-                "ABSENCE_BARSEL",
-                "ABSENCE_FRITAGELSE_FOR_JOBLOG"
-            ]
-        }
-
-    ]
-
-    borgere = momentum.borgere.hent_borgere(filters=filters)
+    borgere = momentum.borgere.hent_borgere(filters=borger_filtre)
 
     if not borgere or len(borgere['data']) == 0:
         return
 
-    for borger in borgere['data']:
-        eksisterende_kødata = workqueue.get_item_by_reference(
-            str(borger["cpr"]), status=WorkItemStatus.COMPLETED
-        )
-        eksisterende_kødata = [
-            item
-            for item in eksisterende_kødata
-            if item.updated_at > datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        ]
+    måned_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    semafor = asyncio.Semaphore(maks_samtidige_opslag)
+
+    async def behandlet_i_måneden(borger) -> bool:
+        # Workqueue-klienten er synkron, så opslagene køres i tråde for at overlappe ventetiden
+        async with semafor:
+            eksisterende_kødata = await asyncio.to_thread(
+                workqueue.get_item_by_reference, str(borger["cpr"]), status=WorkItemStatus.COMPLETED
+            )
+
+        return any(item.updated_at > måned_start for item in eksisterende_kødata)
+
+    behandlet = await asyncio.gather(*(behandlet_i_måneden(borger) for borger in borgere['data']))
+
+    for borger, allerede_behandlet in zip(borgere['data'], behandlet):
+        if not allerede_behandlet:
+            cpr = borger["cpr"]
+            workqueue.add_item({"cpr": cpr}, reference=str(cpr))
+
+
+def udpak(resultat):
+    # Borgerdata hentes samtidigt og på forhånd; en fejl rejses først, når data faktisk bruges
+    if isinstance(resultat, BaseException):
+        raise resultat
+    return resultat
+
+
+async def behandl_item(item):
+    logger = logging.getLogger(__name__)
+
+    with item:
+        data = item.data
+
+        try:
+            # Momentum-klienten er synkron, så kaldene køres i tråde for at kunne behandle flere borgere samtidigt
+            borger = await asyncio.to_thread(momentum.borgere.hent_borger, cpr=item.reference)
 
-        if len(eksisterende_kødata) == 0:
-            borger_data = {
-                "cpr": borger["cpr"]                
-            }
+            if not borger:
+                raise WorkItemError(f"Borger med CPR {item.reference} ikke fundet i Momentum.")
 
-            workqueue.add_item(borger_data, reference=str(borger["cpr"]))
+            personvisitationstatus, job_definition, joblog = await momentum_service.hent_borgerdata(borger)
+
+            if await asyncio.to_thread(momentum_service.fritaget_for_joblog, borger, udpak(personvisitationstatus)):
+                return
+
+            krav_til_jobsøgning = await asyncio.to_thread(momentum_service.hent_krav_til_jobsøgning, borger, udpak(job_definition))
+
+            if krav_til_jobsøgning is None:
+                return
+
+            antal_søgte_jobs = momentum_service.hent_joblog_aktiviteter(borger, udpak(joblog), krav_til_jobsøgning)
+
+            await asyncio.to_thread(
+                momentum_service.kontroller_jobsøgning,
+                borger=borger,
+                krav_til_jobsøgning=krav_til_jobsøgning,
+                antal_søgte_jobs=antal_søgte_jobs
+            )
+
+        except WorkItemError as e:
+            # A WorkItemError represents a soft error that indicates the item should be passed to manual processing or a business logic fault
+            logger.error(f"Error processing item: {data}. Error: {e}")
+            item.fail(str(e))
 
 
 async def process_workqueue(workqueue: Workqueue):
     logger = logging.getLogger(__name__)
+    semafor = asyncio.Semaphore(maks_samtidige_borgere)
+    items = iter(workqueue)
+    tasks = set()
+    fejl = []
+
+    def item_færdigt(task: asyncio.Task):
+        tasks.discard(task)
+        semafor.release()
+
+        if not task.cancelled() and task.exception():
+            fejl.append(task.exception())
 
-    for item in workqueue:
-        with item:
-            data = item.data
- 
-            try:
-                borger = momentum.borgere.hent_borger(cpr=item.reference)
-
-                if not borger:
-                    raise WorkItemError(f"Borger med CPR {item.reference} ikke fundet i Momentum.")
-
-                if momentum_service.fritaget_for_joblog(borger):
-                    continue
-                
-                krav_til_jobsøgning = momentum_service.hent_krav_til_jobsøgning(borger)
-
-                if krav_til_jobsøgning is None:
-                    continue
-
-                antal_søgte_jobs = momentum_service.hent_joblog_aktiviteter(borger)
-                
-                momentum_service.kontroller_jobsøgning(
-                    borger=borger,
-                    krav_til_jobsøgning=krav_til_jobsøgning,
-                    antal_søgte_jobs=antal_søgte_jobs
-                )
-                
-            except WorkItemError as e:
-                # A WorkItemError represents a soft error that indicates the item should be passed to manual processing or a business logic fault
-                logger.error(f"Error processing item: {data}. Error: {e}")
-                item.fail(str(e))
+    while True:
+        # Hent først et nyt item fra køen, når der er plads til at behandle det
+        await semafor.acquire()
+
+        # Uventede fejl (alt andet end WorkItemError) stopper kørslen, så der ikke tages flere items
+        if fejl:
+            break
+
+        try:
+            item = next(items, None)
+        except Exception as e:
+            # Kan næste item ikke hentes, stoppes kørslen, men items i gang gøres færdige først
+            fejl.append(e)
+            break
+
+        if item is None:
+            break
+
+        task = asyncio.create_task(behandl_item(item))
+        task.add_done_callback(item_færdigt)
+        tasks.add(task)
+
+    # Items der allerede er i gang gøres færdige, før en eventuel fejl rejses
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    for e in fejl[1:]:
+        logger.error("Uventet fejl under behandling af item", exc_info=e)
+
+    if fejl:
+        raise fejl[0]
 
 
 if __name__ == "__main__":
@@ -123,11 +184,15 @@ if __name__ == "__main__":
         tracker=tracker,
     )
 
-    # Queue management
-    if "--queue" in sys.argv:
-        workqueue.clear_workqueue(WorkItemStatus.NEW)
-        asyncio.run(populate_queue(workqueue))
-        exit(0)
+    with asyncio.Runner() as runner:
+        # Klienterne er synkrone og kaldes via asyncio.to_thread; hver borger kan have op til tre kald i gang
+        runner.get_loop().set_default_executor(ThreadPoolExecutor(max_workers=maks_samtidige_borgere * 3))
+
+        # Queue management
+        if "--queue" in sys.argv:
+            workqueue.clear_workqueue(WorkItemStatus.NEW)
+            runner.run(populate_queue(workqueue))
+            exit(0)
 
-    # Process workqueue
-    asyncio.run(process_workqueue(workqueue))
+        # Process workqueue
+        runner.run(process_workqueue(workqueue))
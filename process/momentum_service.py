@@ -1,14 +1,22 @@
+import asyncio
 import re
+import threading
 
 from datetime import datetime, timedelta, timezone
 from momentum_client.manager import MomentumClientManager
 from odk_tools.reporting import report
 from odk_tools.tracking import Tracker
 from automation_server_client import WorkItemError
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from requests.exceptions import HTTPError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+from httpx import HTTPStatusError
 
 proces_navn = "Kontrol af joblog"
+krav_antal_mønster = re.compile(r'(\d+)\s+job', re.IGNORECASE)
+iso_tidspunkt_med_tidszone = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:\d{2})')
+
+def er_gateway_timeout(e: BaseException) -> bool:
+    # momentum-client bygger på httpx, så HTTP-fejl kommer som httpx.HTTPStatusError
+    return isinstance(e, HTTPStatusError) and e.response.status_code == 504
 
 class MomentumService:
     def __init__(
@@ -18,6 +26,20 @@ class MomentumService:
     ):
         self.momentum = momentum        
         self.tracker = tracker
+        # Items behandles i flere tråde, og Tracker (pymssql) og report() må ikke bruges samtidigt
+        self._skrive_lås = threading.Lock()
+        self._sagsbehandler_dorf: dict | None = None
+
+        # Joblog kontrolleres for forrige måned; perioden beregnes én gang pr. kørsel
+        now = datetime.now(timezone.utc)
+        self._start_dato = (now.replace(day=1) - timedelta(days=1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        self._slut_dato = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(microseconds=1)
+        self._periode_grænser = (
+            (self._start_dato - timedelta(days=1)).date().isoformat(),
+            (self._start_dato + timedelta(days=1)).date().isoformat(),
+            (self._slut_dato - timedelta(days=1)).date().isoformat(),
+            (self._slut_dato + timedelta(days=1)).date().isoformat(),
+        )
 
     def __parse_date(self, date_str):
         if isinstance(date_str, datetime):
@@ -26,15 +48,44 @@ class MomentumService:
             return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
         return datetime.min.replace(tzinfo=timezone.utc)
 
+    def __i_periode(self, dato) -> bool:
+        # ISO-datoer sammenlignes som strenge på datodelen; kun datoer tæt på periodens grænser parses,
+        # da tidszoneforskydningen kan flytte dem over grænsen. Alt andet end ISO-tidspunkter med tidszone
+        # parses altid, så ugyldige data fejler som før
+        if isinstance(dato, str) and iso_tidspunkt_med_tidszone.fullmatch(dato):
+            dag = dato[:10]
+            ydre_start, indre_start, indre_slut, ydre_slut = self._periode_grænser
+
+            if dag < ydre_start or dag > ydre_slut:
+                return False
+            if indre_start <= dag <= indre_slut:
+                return True
+
+        return self._start_dato <= self.__parse_date(dato) <= self._slut_dato
+
+    def __report(self, **kwargs):
+        with self._skrive_lås:
+            report(**kwargs)
+
+    def __track_task(self):
+        with self._skrive_lås:
+            self.tracker.track_task(proces_navn)
+
+    def __track_partial_task(self):
+        with self._skrive_lås:
+            self.tracker.track_partial_task(proces_navn)
+
     def opret_opgave_til_sagsbehandler(self, borger, beskrivelse):
-        medarbejder = self.momentum.borgere.hent_sagsbehandler("dorf")
+        # Sagsbehandleren ændrer sig ikke under en kørsel, så den hentes kun én gang
+        if not self._sagsbehandler_dorf:
+            self._sagsbehandler_dorf = self.momentum.borgere.hent_sagsbehandler("dorf")
 
-        if not medarbejder:
+        if not self._sagsbehandler_dorf:
             raise WorkItemError("Sagsbehandler 'dorf' ikke fundet i Momentum.")
 
         self.momentum.opgaver.opret_opgave(
             borger=borger,
-            medarbejdere=[medarbejder],
+            medarbejdere=[self._sagsbehandler_dorf],
             forfaldsdato=datetime.now(timezone.utc) + timedelta(days=7),
             titel="Kontrol af joblog",
             beskrivelse=beskrivelse,
@@ -42,7 +93,7 @@ class MomentumService:
         
 
     @retry(
-        retry=retry_if_exception_type(HTTPError),
+        retry=retry_if_exception(er_gateway_timeout),
         stop=stop_after_attempt(10),
         wait=wait_exponential(multiplier=1, min=1, max=10),
         reraise=True
@@ -51,16 +102,26 @@ class MomentumService:
         """Hent personvisitationstatus med retry på 504 fejl."""
         return self.momentum.borgere.hent_personvisitationstatus(borger=borger)
 
-    def fritaget_for_joblog(self, borger) -> bool:
-        personvisitationstatus = self._hent_personvisitationstatus_med_retry(borger)
+    async def hent_borgerdata(self, borger) -> tuple:
+        """Hent personvisitationstatus, jobsøgningsdefinition og joblog samtidigt.
+
+        Fejl returneres i stedet for at blive rejst, så de kan rejses først, når data bruges.
+        """
+        return tuple(await asyncio.gather(
+            asyncio.to_thread(self._hent_personvisitationstatus_med_retry, borger),
+            asyncio.to_thread(self.momentum.borgere.hent_jobsøgningsdefinition, borger=borger),
+            asyncio.to_thread(self.momentum.borgere.hent_joblog, borger=borger),
+            return_exceptions=True
+        ))
 
+    def fritaget_for_joblog(self, borger, personvisitationstatus) -> bool:
         if not personvisitationstatus:
             raise WorkItemError(f"Personvisitationstatus for borger med CPR {borger['cpr']} ikke fundet i Momentum.")
         
         person_exempt_names = personvisitationstatus.get('personExemptNames')
 
         if person_exempt_names and "Brug af Joblog" in person_exempt_names:                    
-            report(
+            self.__report(
                 report_id="kontrol_af_joblog",
                 group="Manuel behandling",
                 json={
@@ -69,14 +130,12 @@ class MomentumService:
                 },
             )
 
-            self.tracker.track_partial_task(proces_navn)
+            self.__track_partial_task()
             return True
         
         return False
 
-    def hent_krav_til_jobsøgning(self, borger) -> int|None:        
-        job_definition = self.momentum.borgere.hent_jobsøgningsdefinition(borger=borger)
-
+    def hent_krav_til_jobsøgning(self, borger, job_definition) -> int|None:        
         if not job_definition:
             raise WorkItemError(f"Jobsøgningsdefinition for borger med CPR {borger['cpr']} ikke fundet i Momentum.")
 
@@ -85,7 +144,7 @@ class MomentumService:
         if krav_tekst is None or len(krav_tekst) == 0:
             self.opret_opgave_til_sagsbehandler(borger, "'Krav til jobsøgning' blev ikke fundet.")
 
-            report(
+            self.__report(
                 report_id="kontrol_af_joblog",
                 group="Behandlet",
                 json={
@@ -94,17 +153,17 @@ class MomentumService:
                     "Beskrivelse": "'Krav til jobsøgning' blev ikke fundet."
                 },
             )
-            self.tracker.track_task(proces_navn)
+            self.__track_task()
             return None
 
 
-        match = re.search(r'(\d+)\s+job', krav_tekst, re.IGNORECASE)
+        match = krav_antal_mønster.search(krav_tekst)
         krav_antal = int(match.group(1)) if match else None
 
         if krav_antal is None:
             self.opret_opgave_til_sagsbehandler(borger, "Der mangler oplysninger om antallet af jobs i 'Krav til jobsøgning'.")
 
-            report(
+            self.__report(
                 report_id="kontrol_af_joblog",
                 group="Behandlet",
                 json={
@@ -113,34 +172,39 @@ class MomentumService:
                     "Beskrivelse": "Der mangler oplysninger om antallet af jobs i 'Krav til jobsøgning'."
                 },
             )
-            self.tracker.track_task(proces_navn)
+            self.__track_task()
             return None
 
         if krav_antal == 0:
-            self.tracker.track_partial_task(proces_navn)
+            self.__track_partial_task()
             return None
         
         return krav_antal
     
-    def hent_joblog_aktiviteter(self, borger) -> int:
-        # Hent joblog aktiviteter
-        joblog = self.momentum.borgere.hent_joblog(borger=borger)
-
+    def hent_joblog_aktiviteter(self, borger, joblog, krav_til_jobsøgning: int) -> int:
         if not joblog:
             raise WorkItemError(f"Joblog for borger med CPR {borger['cpr']} ikke fundet i Momentum.")
         
-        now = datetime.now(timezone.utc)
-        start_dato = (now.replace(day=1) - timedelta(days=1)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        slut_dato = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(microseconds=1)                
-        tidligere_måneds_joblog = [entry for entry in joblog if start_dato <= self.__parse_date(entry.get('submissionDate')) <= slut_dato and start_dato <= self.__parse_date(entry.get('updatedAt')) <= slut_dato]
-        
-        # Hash joblog entries og filtrer duplicates
-        unikke_jobs = {}
-        for joblog_entry in tidligere_måneds_joblog:
-            job_hash = f"{joblog_entry.get('title', '')} {joblog_entry.get('companyName', '')} {joblog_entry.get('companyPostCode', '')} {joblog_entry.get('companyTown', '')} {joblog_entry.get('distanceToCompanyInMeters', '')}"
-            if job_hash not in unikke_jobs:
-                unikke_jobs[job_hash] = joblog_entry
-        
+        # Filtrer på forrige måned og tæl unikke jobs i samme gennemløb
+        unikke_jobs = set()
+        for entry in joblog:
+            if not self.__i_periode(entry.get('submissionDate')):
+                continue
+            if not self.__i_periode(entry.get('updatedAt')):
+                continue
+
+            unikke_jobs.add((
+                entry.get('title', ''),
+                entry.get('companyName', ''),
+                entry.get('companyPostCode', ''),
+                entry.get('companyTown', ''),
+                entry.get('distanceToCompanyInMeters', ''),
+            ))
+
+            # Der tjekkes kun om kravet er opfyldt, så resten af joblog behøver ikke tælles
+            if len(unikke_jobs) >= krav_til_jobsøgning:
+                break
+
         antal_søgte_jobs = len(unikke_jobs)
 
         return antal_søgte_jobs
@@ -149,7 +213,7 @@ class MomentumService:
         if krav_til_jobsøgning > 0 and antal_søgte_jobs == 0:
             self.opret_opgave_til_sagsbehandler(borger, "Der var ikke registreret nogen jobs i joblog.")
 
-            report(
+            self.__report(
                 report_id="kontrol_af_joblog",
                 group="Behandlet",
                 json={
@@ -158,12 +222,12 @@ class MomentumService:
                     "Beskrivelse": "Der var ikke registreret nogen jobs i joblog."
                 },
             )
-            self.tracker.track_task(proces_navn)
+            self.__track_task()
 
         elif antal_søgte_jobs < krav_til_jobsøgning:
             self.opret_opgave_til_sagsbehandler(borger, "Der er registreret for få job i joblog.")
 
-            report(
+            self.__report(
                 report_id="kontrol_af_joblog",
                 group="Behandlet",
                 json={
@@ -172,5 +236,5 @@ class MomentumService:
                     "Beskrivelse": "Der er registreret for få job i joblog."
                 },
             )
-            self.tracker.track_task(proces_navn)
+            self.__track_task()
             
\ No newline at end of file